@@ -3,24 +3,38 @@ CementAI Optimizer - FastAPI Backend
 Complete 8 BQML Models + Gemini AI Integration
 """
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
-from google.cloud import bigquery
+from contextlib import asynccontextmanager
+from google.cloud import bigquery, firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.auth.transport import requests as google_requests
+from google.oauth2 import id_token
 import logging
+import os
 import random
+import threading
+import uuid
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the retraining worker with the server"""
+    ensure_retrain_worker()
+    yield
+
 # Initialize FastAPI
 app = FastAPI(
     title="CementAI Optimizer API",
     description="AI-Powered Cement Plant Optimization - 8 BQML Models + Gemini Pro",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORS Configuration
@@ -44,6 +58,14 @@ except Exception as e:
     logger.error(f"❌ BigQuery initialization failed: {e}")
     client = None
 
+# Initialize Firestore Client (retraining job state)
+try:
+    firestore_client = firestore.Client(project=PROJECT_ID)
+    logger.info(f"✅ Firestore client initialized: {PROJECT_ID}")
+except Exception as e:
+    logger.error(f"❌ Firestore initialization failed: {e}")
+    firestore_client = None
+
 # ==================== 8 BQML MODELS ====================
 # Model names MUST match actual BigQuery tables
 BQML_MODELS = [
@@ -432,6 +454,820 @@ async def health_check():
         "models_count": len(BQML_MODELS)
     }
 
+# ==================== BQML RETRAINING ====================
+# Incremental retraining on new daily partitions of the feature table.
+# Trigger POST /api/models/retrain from Cloud Scheduler (see DEPLOYMENT_COMMANDS.md).
+# Jobs and the cross-instance "active job" lock live in Firestore; every instance
+# runs a worker that claims the queued job, so queued work survives restarts.
+
+TRAINING_TABLE = f"{PROJECT_ID}.{DATASET_ID}.plant_features"
+TRAINING_STATE_TABLE = f"{PROJECT_ID}.{DATASET_ID}.model_training_state"
+PARTITION_COLUMN = "event_time"
+RETRAIN_JOBS_COLLECTION = "retrain_jobs"
+RETRAIN_LOCKS_COLLECTION = "retrain_locks"
+RETRAIN_LOCK_DOCUMENT = "active"
+
+# Worker timing: heartbeat while running, poll for queued jobs, fail silent jobs
+RETRAIN_HEARTBEAT_SECONDS = 60
+RETRAIN_POLL_SECONDS = 30
+RETRAIN_STALE_AFTER = timedelta(minutes=10)
+
+# POST /api/models/retrain accepts Google OIDC tokens for these callers only
+RETRAIN_OIDC_AUDIENCE = os.environ.get("RETRAIN_OIDC_AUDIENCE", "")
+RETRAIN_INVOKER_EMAILS = {
+    email.strip() for email in os.environ.get("RETRAIN_INVOKER_EMAILS", "").split(",") if email.strip()
+}
+
+# Model types that BQML can warm-start from the previously trained weights
+WARM_START_MODEL_TYPES = {
+    "LINEAR_REG",
+    "LOGISTIC_REG",
+    "DNN_REGRESSOR",
+    "DNN_CLASSIFIER"
+}
+
+# Upper bound on the training range: cold-start types always retrain on this
+# trailing window, warm starts never look further back than it
+RETRAIN_WINDOW_DAYS = 90
+
+# Expected type, label and comparison metric of each deployed model.
+# Features and training options are read from the deployed model itself.
+# ARIMA_PLUS production models cannot be evaluated at the candidate's cutoff,
+# so forecasters are promoted on a valid candidate metric without comparison.
+RETRAIN_CONFIG = {
+    "energy_regressor": {
+        "model_type": "BOOSTED_TREE_REGRESSOR",
+        "label": "energy_kwh_per_ton",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    },
+    "quality_regressor": {
+        "model_type": "DNN_REGRESSOR",
+        "label": "quality_score",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    },
+    "pm_risk_classifier": {
+        "model_type": "LOGISTIC_REG",
+        "label": "pm_exceedance_flag",
+        "metric": "roc_auc",
+        "higher_is_better": True
+    },
+    "tsr_optimizer": {
+        "model_type": "LINEAR_REG",
+        "label": "optimal_tsr_pct",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    },
+    "maintenance_predictor": {
+        "model_type": "BOOSTED_TREE_CLASSIFIER",
+        "label": "failure_risk_flag",
+        "metric": "roc_auc",
+        "higher_is_better": True
+    },
+    "heat_loss_regressor": {
+        "model_type": "LINEAR_REG",
+        "label": "stack_heat_loss_kw",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    },
+    "mill_optimizer": {
+        "model_type": "BOOSTED_TREE_REGRESSOR",
+        "label": "optimal_separator_speed_rpm",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    },
+    "throughput_forecaster": {
+        "model_type": "ARIMA_PLUS",
+        "label": "throughput_tph",
+        "metric": "mean_absolute_error",
+        "higher_is_better": False
+    }
+}
+
+# BigQuery API model types -> CREATE MODEL model_type
+MODEL_TYPE_DDL_NAMES = {
+    "LINEAR_REGRESSION": "LINEAR_REG",
+    "LOGISTIC_REGRESSION": "LOGISTIC_REG",
+    "BOOSTED_TREE_REGRESSOR": "BOOSTED_TREE_REGRESSOR",
+    "BOOSTED_TREE_CLASSIFIER": "BOOSTED_TREE_CLASSIFIER",
+    "DNN_REGRESSOR": "DNN_REGRESSOR",
+    "DNN_CLASSIFIER": "DNN_CLASSIFIER",
+    "ARIMA_PLUS": "ARIMA_PLUS"
+}
+
+# trainingOptions of the last training run -> CREATE MODEL option names.
+# Any other option makes the model a CONFIG_MISMATCH rather than being dropped.
+TRAINING_OPTION_DDL_NAMES = {
+    "maxIterations": "max_iterations",
+    "l1Regularization": "l1_reg",
+    "l2Regularization": "l2_reg",
+    "learnRate": "learn_rate",
+    "learnRateStrategy": "learn_rate_strategy",
+    "initialLearnRate": "ls_init_learn_rate",
+    "earlyStop": "early_stop",
+    "minRelativeProgress": "min_rel_progress",
+    "dataSplitMethod": "data_split_method",
+    "dataSplitEvalFraction": "data_split_eval_fraction",
+    "dataSplitColumn": "data_split_col",
+    "optimizationStrategy": "optimize_strategy",
+    "calculatePValues": "calculate_p_values",
+    "enableGlobalExplain": "enable_global_explain",
+    "categoryEncodingMethod": "category_encoding_method",
+    "autoClassWeights": "auto_class_weights",
+    "hiddenUnits": "hidden_units",
+    "batchSize": "batch_size",
+    "dropout": "dropout",
+    "activationFn": "activation_fn",
+    "optimizer": "optimizer",
+    "boosterType": "booster_type",
+    "treeMethod": "tree_method",
+    "dartNormalizeType": "dart_normalize_type",
+    "maxTreeDepth": "max_tree_depth",
+    "subsample": "subsample",
+    "minSplitLoss": "min_split_loss",
+    "minTreeChildWeight": "min_tree_child_weight",
+    "colsampleBytree": "colsample_bytree",
+    "colsampleBylevel": "colsample_bylevel",
+    "colsampleBynode": "colsample_bynode",
+    "numParallelTree": "num_parallel_tree",
+    "horizon": "horizon",
+    "autoArima": "auto_arima",
+    "autoArimaMaxOrder": "auto_arima_max_order",
+    "autoArimaMinOrder": "auto_arima_min_order",
+    "dataFrequency": "data_frequency",
+    "holidayRegion": "holiday_region",
+    "includeDrift": "include_drift",
+    "decomposeTimeSeries": "decompose_time_series",
+    "cleanSpikesAndDips": "clean_spikes_and_dips",
+    "adjustStepChanges": "adjust_step_changes",
+    "trendSmoothingWindowSize": "trend_smoothing_window_size"
+}
+
+# Options set explicitly by build_training_query or informational only
+MANAGED_TRAINING_OPTIONS = {
+    "inputLabelColumns",
+    "timeSeriesTimestampColumn",
+    "timeSeriesDataColumn",
+    "warmStart",
+    "lossType"
+}
+
+# Wakes this instance's worker when a job is queued
+retrain_wake = threading.Event()
+retrain_worker: Optional[threading.Thread] = None
+retrain_worker_lock = threading.Lock()
+RETRAIN_WORKER_ID = uuid.uuid4().hex[:8]
+
+
+class RetrainRequest(BaseModel):
+    """Retraining job request"""
+    models: Optional[List[str]] = Field(None, description="Models to retrain (default: all 8)")
+
+
+def shift_partition(partition: str, days: int) -> str:
+    """Partition id (YYYYMMDD) shifted by a number of days"""
+    return (datetime.strptime(partition, "%Y%m%d") + timedelta(days=days)).strftime("%Y%m%d")
+
+
+def ensure_training_state_table(bq_client) -> None:
+    """Create the watermark table if it does not exist yet"""
+    query = f"""
+    CREATE TABLE IF NOT EXISTS `{TRAINING_STATE_TABLE}` (
+        model_name STRING NOT NULL,
+        last_partition STRING NOT NULL,
+        metric_name STRING,
+        metric_value FLOAT64,
+        promoted_at TIMESTAMP
+    )
+    """
+    bq_client.query(query).result()
+
+
+def get_training_watermarks(bq_client) -> Dict[str, Dict[str, Any]]:
+    """Newest partition each model was trained on, keyed by model name"""
+    ensure_training_state_table(bq_client)
+    query = f"""
+    SELECT model_name, last_partition, metric_name, metric_value, promoted_at
+    FROM `{TRAINING_STATE_TABLE}`
+    """
+    watermarks = {}
+    for row in bq_client.query(query).result():
+        watermarks[row.model_name] = {
+            "last_partition": row.last_partition,
+            "metric_name": row.metric_name,
+            "metric_value": row.metric_value,
+            "promoted_at": row.promoted_at.isoformat() if row.promoted_at else None
+        }
+    return watermarks
+
+
+def save_training_watermark(bq_client, model_name: str, last_partition: str,
+                            metric_name: str, metric_value: Optional[float]) -> None:
+    """Record the newest partition a promoted model was trained on"""
+    query = f"""
+    MERGE `{TRAINING_STATE_TABLE}` AS target
+    USING (
+        SELECT
+            @model_name AS model_name,
+            @last_partition AS last_partition,
+            @metric_name AS metric_name,
+            @metric_value AS metric_value,
+            CURRENT_TIMESTAMP() AS promoted_at
+    ) AS source
+    ON target.model_name = source.model_name
+    WHEN MATCHED THEN
+        UPDATE SET
+            last_partition = source.last_partition,
+            metric_name = source.metric_name,
+            metric_value = source.metric_value,
+            promoted_at = source.promoted_at
+    WHEN NOT MATCHED THEN
+        INSERT ROW
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("model_name", "STRING", model_name),
+        bigquery.ScalarQueryParameter("last_partition", "STRING", last_partition),
+        bigquery.ScalarQueryParameter("metric_name", "STRING", metric_name),
+        bigquery.ScalarQueryParameter("metric_value", "FLOAT64", metric_value)
+    ])
+    bq_client.query(query, job_config=job_config).result()
+
+
+def list_complete_partitions(bq_client) -> List[str]:
+    """Non-empty daily partitions of the training table, excluding today's (still filling)"""
+    table_name = TRAINING_TABLE.split(".")[-1]
+    query = f"""
+    SELECT partition_id
+    FROM `{PROJECT_ID}.{DATASET_ID}.INFORMATION_SCHEMA.PARTITIONS`
+    WHERE table_name = '{table_name}'
+      AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+      AND total_rows > 0
+    ORDER BY partition_id
+    """
+    today = datetime.utcnow().strftime("%Y%m%d")
+    return [row.partition_id for row in bq_client.query(query).result() if row.partition_id < today]
+
+
+def format_option_value(value: Any) -> str:
+    """Render a REST trainingOptions value as a CREATE MODEL option literal"""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(format_option_value(v) for v in value) + "]"
+    text = str(value)
+    try:
+        # INT64 options arrive as strings in REST format
+        float(text)
+        return text
+    except ValueError:
+        return "'" + text.replace("'", "\\'") + "'"
+
+
+def resolve_training_spec(model_name: str, model) -> Dict[str, Any]:
+    """
+    Model type, label, columns and CREATE MODEL options of the deployed model.
+    Raises ValueError when they differ from RETRAIN_CONFIG or cannot be reproduced.
+    """
+    config = RETRAIN_CONFIG[model_name]
+    model_type = MODEL_TYPE_DDL_NAMES.get(model.model_type)
+    if model_type != config["model_type"]:
+        raise ValueError(f"deployed model type {model.model_type} does not match {config['model_type']}")
+    if not model.training_runs:
+        raise ValueError("deployed model has no training run metadata")
+    training_options = model.training_runs[-1].get("trainingOptions", {})
+
+    options = [f"model_type='{model_type}'"]
+    if model_type == "ARIMA_PLUS":
+        label = training_options.get("timeSeriesDataColumn")
+        timestamp_column = training_options.get("timeSeriesTimestampColumn")
+        if timestamp_column != PARTITION_COLUMN:
+            raise ValueError(f"time series timestamp column {timestamp_column} is not {PARTITION_COLUMN}")
+        columns = [PARTITION_COLUMN, label]
+        options += [
+            f"time_series_timestamp_col='{PARTITION_COLUMN}'",
+            f"time_series_data_col='{label}'"
+        ]
+    else:
+        labels = [c.name for c in model.label_columns] or training_options.get("inputLabelColumns", [])
+        label = labels[0] if len(labels) == 1 else None
+        columns = [f.name for f in model.feature_columns] + [label]
+        options.append(f"input_label_cols=['{label}']")
+    if label != config["label"]:
+        raise ValueError(f"deployed label {label} does not match {config['label']}")
+
+    unsupported = sorted(
+        key for key in training_options
+        if key not in TRAINING_OPTION_DDL_NAMES and key not in MANAGED_TRAINING_OPTIONS
+    )
+    if unsupported:
+        raise ValueError(f"cannot reproduce training options: {', '.join(unsupported)}")
+    for key, value in training_options.items():
+        if key in TRAINING_OPTION_DDL_NAMES:
+            options.append(f"{TRAINING_OPTION_DDL_NAMES[key]}={format_option_value(value)}")
+
+    return {"model_type": model_type, "label": label, "columns": columns, "options": options}
+
+
+def build_feature_select(columns: List[str], after: str, through: str) -> str:
+    """SELECT of the given columns over the partitions in (after, through]"""
+    return f"""
+    SELECT {", ".join(columns)}
+    FROM `{TRAINING_TABLE}`
+    WHERE DATE({PARTITION_COLUMN}) > PARSE_DATE('%Y%m%d', '{after}')
+      AND DATE({PARTITION_COLUMN}) <= PARSE_DATE('%Y%m%d', '{through}')
+    """
+
+
+def build_training_query(spec: Dict[str, Any], target: str, after: str,
+                         through: str, warm_start: bool) -> str:
+    """CREATE OR REPLACE MODEL statement reusing the deployed model's options"""
+    options = list(spec["options"])
+    if warm_start:
+        options.append("warm_start=TRUE")
+    return f"""
+    CREATE OR REPLACE MODEL `{target}`
+    OPTIONS({", ".join(options)}) AS
+    {build_feature_select(spec["columns"], after, through)}
+    """
+
+
+def count_time_points(bq_client, partition: str) -> int:
+    """Distinct timestamps in a partition, used as the ARIMA evaluation horizon"""
+    query = f"""
+    SELECT COUNT(DISTINCT {PARTITION_COLUMN}) AS points
+    FROM `{TRAINING_TABLE}`
+    WHERE DATE({PARTITION_COLUMN}) = PARSE_DATE('%Y%m%d', '{partition}')
+    """
+    rows = list(bq_client.query(query).result())
+    return int(rows[0].points) if rows else 0
+
+
+def evaluate_model(bq_client, model_name: str, target: str, spec: Dict[str, Any],
+                   partition: str) -> Optional[float]:
+    """Evaluate a model on a single partition and return its configured metric"""
+    config = RETRAIN_CONFIG[model_name]
+    evaluation_data = build_feature_select(spec["columns"], shift_partition(partition, -1), partition)
+    settings = ""
+    if spec["model_type"] == "ARIMA_PLUS":
+        # Forecast exactly the held-out day from the end of the training data
+        settings = f", STRUCT(TRUE AS perform_aggregation, {count_time_points(bq_client, partition)} AS horizon)"
+    query = f"""
+    SELECT *
+    FROM ML.EVALUATE(MODEL `{target}`, ({evaluation_data}){settings})
+    """
+    rows = list(bq_client.query(query).result())
+    if not rows:
+        return None
+    value = rows[0][config["metric"]]
+    return float(value) if value is not None else None
+
+
+def is_not_regressed(model_name: str, candidate: Optional[float], production: Optional[float]) -> bool:
+    """True when the candidate metric is at least as good as production"""
+    if candidate is None:
+        return False
+    if production is None:
+        return True
+    if RETRAIN_CONFIG[model_name]["higher_is_better"]:
+        return candidate >= production
+    return candidate <= production
+
+
+def retrain_model(bq_client, job_id: str, model_name: str, watermarks: Dict[str, Dict[str, Any]],
+                  partitions: List[str], set_stage) -> Dict[str, Any]:
+    """
+    Retrain a deployed model once partitions newer than its watermark exist and
+    promote the candidate if its metric on the newest (held-out) partition did not regress.
+
+    Warm-startable models continue from production on the partitions since the
+    watermark; the rest are retrained from scratch. Both are capped to the
+    trailing RETRAIN_WINDOW_DAYS.
+    """
+    config = RETRAIN_CONFIG[model_name]
+    production = f"{PROJECT_ID}.{DATASET_ID}.{model_name}"
+    candidate = f"{production}_candidate_{job_id[:8]}"
+    result = {"model_name": model_name}
+
+    set_stage("resolving watermark")
+    try:
+        model = bq_client.get_model(production)
+    except NotFound:
+        result.update(status="NOT_DEPLOYED", promoted=False)
+        return result
+
+    try:
+        spec = resolve_training_spec(model_name, model)
+    except ValueError as e:
+        result.update(status="CONFIG_MISMATCH", promoted=False, error=str(e))
+        return result
+
+    watermark = watermarks.get(model_name, {}).get("last_partition")
+    if watermark is None:
+        # Models created outside this service: assume data before their creation day was used
+        watermark = shift_partition(model.created.strftime("%Y%m%d"), -1)
+
+    new_partitions = [p for p in partitions if p > watermark]
+    result.update(previous_partition=watermark, new_partitions=len(new_partitions))
+    # The newest partition is held out for evaluation, so at least two are needed
+    if len(new_partitions) < 2:
+        result.update(status="UP_TO_DATE", promoted=False)
+        return result
+
+    train_through = new_partitions[-2]
+    holdout = new_partitions[-1]
+    warm_start = spec["model_type"] in WARM_START_MODEL_TYPES
+    window_start = shift_partition(train_through, -RETRAIN_WINDOW_DAYS)
+    train_after = max(watermark, window_start) if warm_start else window_start
+    compare_production = spec["model_type"] != "ARIMA_PLUS"
+    state_error = None
+
+    try:
+        if warm_start:
+            set_stage("copying production model")
+            copy_config = bigquery.CopyJobConfig(write_disposition="WRITE_TRUNCATE")
+            bq_client.copy_table(production, candidate, job_config=copy_config).result()
+
+        set_stage(f"training on {shift_partition(train_after, 1)}..{train_through}")
+        bq_client.query(build_training_query(spec, candidate, train_after, train_through, warm_start)).result()
+
+        set_stage(f"evaluating on {holdout}")
+        candidate_metric = evaluate_model(bq_client, model_name, candidate, spec, holdout)
+        production_metric = None
+        if compare_production:
+            production_metric = evaluate_model(bq_client, model_name, production, spec, holdout)
+
+        promoted = is_not_regressed(model_name, candidate_metric, production_metric)
+        if promoted:
+            set_stage("promoting candidate")
+            copy_config = bigquery.CopyJobConfig(write_disposition="WRITE_TRUNCATE")
+            bq_client.copy_table(candidate, production, job_config=copy_config).result()
+            try:
+                save_training_watermark(bq_client, model_name, train_through, config["metric"], candidate_metric)
+            except Exception as e:
+                # Production already holds the new weights; surface the stale watermark
+                logger.error(f"Promoted {model_name} but could not save its watermark: {e}")
+                state_error = str(e)
+    finally:
+        try:
+            bq_client.delete_model(candidate, not_found_ok=True)
+        except Exception as e:
+            logger.warning(f"Could not delete candidate {candidate}: {e}")
+
+    if state_error:
+        status = "PROMOTED_STATE_NOT_SAVED"
+    else:
+        status = "PROMOTED" if promoted else "REJECTED"
+    result.update(
+        status=status,
+        promoted=promoted,
+        trained_after=train_after,
+        trained_through=train_through,
+        holdout_partition=holdout,
+        warm_start=warm_start,
+        comparison="candidate_vs_production" if compare_production else "candidate_only",
+        metric=config["metric"],
+        candidate_metric=candidate_metric,
+        production_metric=production_metric
+    )
+    if state_error:
+        result["error"] = state_error
+    return result
+
+
+def retrain_job_ref(job_id: str):
+    return firestore_client.collection(RETRAIN_JOBS_COLLECTION).document(job_id)
+
+
+def retrain_lock_ref():
+    return firestore_client.collection(RETRAIN_LOCKS_COLLECTION).document(RETRAIN_LOCK_DOCUMENT)
+
+
+def is_stale(timestamp: str) -> bool:
+    """True when an ISO timestamp is older than RETRAIN_STALE_AFTER"""
+    return datetime.utcnow() - datetime.fromisoformat(timestamp) > RETRAIN_STALE_AFTER
+
+
+def create_retrain_job(job_id: str, models: List[str]) -> Dict[str, Any]:
+    """Persist a new queued job"""
+    now = datetime.utcnow().isoformat()
+    job = {
+        "job_id": job_id,
+        "status": "QUEUED",
+        "models": models,
+        "completed_models": 0,
+        "total_models": len(models),
+        "progress_pct": 0.0,
+        "current_model": None,
+        "stage": None,
+        "results": [],
+        "created_at": now,
+        "updated_at": now
+    }
+    retrain_job_ref(job_id).set(job)
+    return job
+
+
+def update_retrain_job(job_id: str, **fields) -> None:
+    """Merge status fields into a persisted job; also serves as the heartbeat"""
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    retrain_job_ref(job_id).set(fields, merge=True)
+
+
+def reap_retrain_lock() -> Optional[Dict[str, Any]]:
+    """
+    Return the job holding the lock while it is queued or still heartbeating.
+    Otherwise mark a silent RUNNING job FAILED and release the lock.
+    """
+    lock_snapshot = retrain_lock_ref().get()
+    if not lock_snapshot.exists:
+        return None
+    lock = lock_snapshot.to_dict()
+    job_snapshot = retrain_job_ref(lock["job_id"]).get()
+
+    if job_snapshot.exists:
+        job = job_snapshot.to_dict()
+        if job["status"] == "QUEUED" or (job["status"] == "RUNNING" and not is_stale(job["updated_at"])):
+            return job
+        if job["status"] == "RUNNING":
+            # Instance died, scaled in or was replaced by a rollout mid-job
+            now = datetime.utcnow().isoformat()
+            try:
+                retrain_job_ref(lock["job_id"]).update(
+                    {
+                        "status": "FAILED",
+                        "error": f"No heartbeat since {job['updated_at']}",
+                        "finished_at": now,
+                        "updated_at": now
+                    },
+                    option=firestore_client.write_option(last_update_time=job_snapshot.update_time)
+                )
+            except (FailedPrecondition, NotFound):
+                # The owner wrote a heartbeat meanwhile
+                return job
+            logger.warning(f"Retrain job {lock['job_id']} marked FAILED after missing heartbeats")
+    elif not is_stale(lock["created_at"]):
+        # Lock taken, job document not written yet
+        return {"job_id": lock["job_id"], "status": "QUEUED"}
+
+    try:
+        retrain_lock_ref().delete(option=firestore_client.write_option(last_update_time=lock_snapshot.update_time))
+    except (FailedPrecondition, NotFound):
+        pass
+    return None
+
+
+def acquire_retrain_lock(job_id: str) -> Optional[Dict[str, Any]]:
+    """Take the cross-instance lock for a new job; returns the active job if one holds it"""
+    for _ in range(2):
+        try:
+            retrain_lock_ref().create({"job_id": job_id, "created_at": datetime.utcnow().isoformat()})
+            return None
+        except AlreadyExists:
+            active = reap_retrain_lock()
+            if active:
+                return active
+    return {"job_id": None, "status": "UNKNOWN"}
+
+
+def release_retrain_lock(job_id: str) -> None:
+    """Release the lock if this job still holds it"""
+    lock_snapshot = retrain_lock_ref().get()
+    if not lock_snapshot.exists or lock_snapshot.to_dict()["job_id"] != job_id:
+        return
+    try:
+        retrain_lock_ref().delete(option=firestore_client.write_option(last_update_time=lock_snapshot.update_time))
+    except (FailedPrecondition, NotFound):
+        pass
+
+
+def claim_retrain_job() -> Optional[Dict[str, Any]]:
+    """Move the queued job holding the lock to RUNNING; None if there is nothing to claim"""
+    active = reap_retrain_lock()
+    if not active or active["status"] != "QUEUED":
+        return None
+    job_snapshot = retrain_job_ref(active["job_id"]).get()
+    if not job_snapshot.exists or job_snapshot.to_dict()["status"] != "QUEUED":
+        return None
+    now = datetime.utcnow().isoformat()
+    try:
+        retrain_job_ref(active["job_id"]).update(
+            {"status": "RUNNING", "worker": RETRAIN_WORKER_ID, "started_at": now, "updated_at": now},
+            option=firestore_client.write_option(last_update_time=job_snapshot.update_time)
+        )
+    except (FailedPrecondition, NotFound):
+        # Claimed by another instance
+        return None
+    return job_snapshot.to_dict()
+
+
+def run_retrain_job(job_id: str, models: List[str], bq_client) -> None:
+    """Execute a claimed retraining job, one model at a time"""
+    try:
+        watermarks = get_training_watermarks(bq_client)
+        partitions = list_complete_partitions(bq_client)
+    except Exception as e:
+        logger.error(f"Retrain job {job_id} failed to load partitions: {e}")
+        update_retrain_job(job_id, status="FAILED", error=str(e), finished_at=datetime.utcnow().isoformat())
+        return
+
+    results = []
+    for index, model_name in enumerate(models):
+        def set_stage(stage: str, model_name=model_name):
+            update_retrain_job(job_id, current_model=model_name, stage=stage)
+
+        try:
+            result = retrain_model(bq_client, job_id, model_name, watermarks, partitions, set_stage)
+        except Exception as e:
+            logger.error(f"Retraining {model_name} failed: {e}")
+            result = {"model_name": model_name, "status": "FAILED", "promoted": False, "error": str(e)}
+
+        logger.info(f"Retrain job {job_id}: {model_name} -> {result['status']}")
+        results.append(result)
+        update_retrain_job(
+            job_id,
+            results=list(results),
+            completed_models=index + 1,
+            progress_pct=round((index + 1) / len(models) * 100, 1)
+        )
+
+    failed = any(r["status"] in ("FAILED", "PROMOTED_STATE_NOT_SAVED", "CONFIG_MISMATCH") for r in results)
+    update_retrain_job(
+        job_id,
+        status="COMPLETED_WITH_ERRORS" if failed else "COMPLETED",
+        current_model=None,
+        stage=None,
+        finished_at=datetime.utcnow().isoformat()
+    )
+
+
+def heartbeat_loop(job_id: str, stop: threading.Event) -> None:
+    """Refresh updated_at while long BigQuery statements run"""
+    while not stop.wait(RETRAIN_HEARTBEAT_SECONDS):
+        try:
+            update_retrain_job(job_id)
+        except Exception as e:
+            logger.warning(f"Retrain job {job_id} heartbeat failed: {e}")
+
+
+def process_retrain_job(job: Dict[str, Any], bq_client) -> None:
+    """Run a claimed job under a heartbeat and release the lock afterwards"""
+    job_id = job["job_id"]
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_loop, args=(job_id, stop), daemon=True)
+    heartbeat.start()
+    try:
+        run_retrain_job(job_id, job["models"], bq_client)
+    except Exception as e:
+        logger.error(f"Retrain job {job_id} crashed: {e}")
+        update_retrain_job(job_id, status="FAILED", error=str(e), finished_at=datetime.utcnow().isoformat())
+    finally:
+        stop.set()
+        heartbeat.join()
+        release_retrain_lock(job_id)
+
+
+def retrain_worker_loop() -> None:
+    """Claim and run queued jobs; also reaps jobs whose instance went away"""
+    while True:
+        try:
+            job = claim_retrain_job()
+            if job:
+                process_retrain_job(job, client)
+                continue
+        except Exception as e:
+            logger.error(f"Retrain worker error: {e}")
+        retrain_wake.wait(RETRAIN_POLL_SECONDS)
+        retrain_wake.clear()
+
+
+def ensure_retrain_worker() -> None:
+    """Start this instance's worker once both clients are available"""
+    global retrain_worker
+    if not client or not firestore_client:
+        return
+    with retrain_worker_lock:
+        if retrain_worker is None or not retrain_worker.is_alive():
+            retrain_worker = threading.Thread(target=retrain_worker_loop, name="bqml-retrain", daemon=True)
+            retrain_worker.start()
+
+
+def require_retrain_clients() -> None:
+    """503 unless both BigQuery and Firestore are available"""
+    if not client:
+        raise HTTPException(status_code=503, detail="BigQuery client not initialized")
+    if not firestore_client:
+        raise HTTPException(status_code=503, detail="Firestore client not initialized")
+
+
+def verify_retrain_invoker(authorization: Optional[str]) -> str:
+    """Validate a Google OIDC bearer token from an allowed service account"""
+    if not RETRAIN_OIDC_AUDIENCE or not RETRAIN_INVOKER_EMAILS:
+        raise HTTPException(status_code=503, detail="Retraining trigger not configured")
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    try:
+        claims = id_token.verify_oauth2_token(
+            authorization[len("Bearer "):], google_requests.Request(), audience=RETRAIN_OIDC_AUDIENCE
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
+    if not claims.get("email_verified") or claims.get("email") not in RETRAIN_INVOKER_EMAILS:
+        raise HTTPException(status_code=403, detail="Caller may not trigger retraining")
+    return claims["email"]
+
+
+@app.post("/api/models/retrain", status_code=202)
+async def queue_retrain(request: Optional[RetrainRequest] = None,
+                        authorization: Optional[str] = Header(None)):
+    """Queue an incremental retraining job (intended for Cloud Scheduler)"""
+    invoker = verify_retrain_invoker(authorization)
+    require_retrain_clients()
+
+    models = BQML_MODELS
+    if request and request.models is not None:
+        if not request.models:
+            raise HTTPException(status_code=400, detail="models must not be empty")
+        models = list(dict.fromkeys(request.models))
+    unknown = [m for m in models if m not in RETRAIN_CONFIG]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown models: {', '.join(unknown)}")
+
+    job_id = str(uuid.uuid4())
+    try:
+        active = acquire_retrain_lock(job_id)
+    except Exception as e:
+        logger.error(f"Could not acquire retrain lock: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if active:
+        raise HTTPException(status_code=409, detail={
+            "message": "A retraining job is already queued or running",
+            "job_id": active["job_id"],
+            "status": active["status"]
+        })
+
+    try:
+        create_retrain_job(job_id, models)
+    except Exception as e:
+        logger.error(f"Could not create retrain job: {e}")
+        release_retrain_lock(job_id)
+        raise HTTPException(status_code=500, detail=str(e))
+    logger.info(f"Retrain job {job_id} queued by {invoker}")
+    ensure_retrain_worker()
+    retrain_wake.set()
+
+    return {
+        "job_id": job_id,
+        "status": "QUEUED",
+        "models": models
+    }
+
+
+@app.get("/api/models/retrain/jobs")
+async def list_retrain_jobs(limit: int = Query(20, ge=1, le=100)):
+    """List retraining jobs, newest first"""
+    require_retrain_clients()
+    try:
+        query = (
+            firestore_client.collection(RETRAIN_JOBS_COLLECTION)
+            .order_by("created_at", direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        return {"jobs": [doc.to_dict() for doc in query.stream()]}
+    except Exception as e:
+        logger.error(f"Retrain jobs error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/models/retrain/jobs/{job_id}")
+async def get_retrain_job(job_id: str):
+    """Status and progress of a retraining job"""
+    require_retrain_clients()
+    snapshot = retrain_job_ref(job_id).get()
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail=f"Retrain job {job_id} not found")
+    return snapshot.to_dict()
+
+
+@app.get("/api/models/training-state")
+async def get_training_state():
+    """Newest partition each BQML model was trained on"""
+    if not client:
+        raise HTTPException(status_code=503, detail="BigQuery client not initialized")
+    try:
+        watermarks = get_training_watermarks(client)
+        return {
+            "models": [
+                {"model_name": m, **watermarks.get(m, {"last_partition": None})}
+                for m in BQML_MODELS
+            ]
+        }
+    except Exception as e:
+        logger.error(f"Training state error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # ==================== GEMINI CHAT ENDPOINT ====================
 # ADD THE ENTIRE CHAT ENDPOINT CODE HERE
 
@@ -0,0 +1,234 @@
+"""
+Shared fixtures: fake BigQuery and Firestore clients for the retraining orchestrator
+"""
+
+import itertools
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+JOB_ID = "0123abcd-0000-4000-8000-000000000000"
+
+# BigQuery API model types for each DDL model type
+API_MODEL_TYPES = {ddl: api for api, ddl in main.MODEL_TYPE_DDL_NAMES.items()}
+
+
+class FakeRow(dict):
+    """Row supporting both attribute and key access, like bigquery.Row"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeJob:
+    def __init__(self, rows=None):
+        self.rows = rows or []
+
+    def result(self):
+        return list(self.rows)
+
+
+class FakeBigQueryClient:
+    """
+    In-memory stand-in for bigquery.Client covering what the orchestrator uses:
+    query().result(), get_model, copy_table and delete_model
+    """
+
+    def __init__(self, partitions=None, models=None, state=None, metrics=None, time_points=24):
+        self.partitions = partitions or []
+        # model_name -> fake_model(...)
+        self.models = models or {}
+        # model_name -> last_partition
+        self.state = state or {}
+        # fully qualified model id -> {metric: value}
+        self.metrics = metrics or {}
+        self.time_points = time_points
+        self.queries = []
+        self.copies = []
+        self.deleted = []
+        self.fail_training = False
+        self.fail_merge = False
+
+    def query(self, sql, job_config=None):
+        self.queries.append(sql)
+        if "INFORMATION_SCHEMA.PARTITIONS" in sql:
+            return FakeJob([FakeRow(partition_id=p) for p in self.partitions])
+        if "CREATE TABLE IF NOT EXISTS" in sql:
+            return FakeJob()
+        if sql.strip().startswith("SELECT model_name"):
+            return FakeJob([
+                FakeRow(model_name=name, last_partition=partition, metric_name=None,
+                        metric_value=None, promoted_at=None)
+                for name, partition in self.state.items()
+            ])
+        if "MERGE" in sql:
+            if self.fail_merge:
+                raise RuntimeError("merge failed")
+            params = {p.name: p.value for p in job_config.query_parameters}
+            self.state[params["model_name"]] = params["last_partition"]
+            return FakeJob()
+        if "CREATE OR REPLACE MODEL" in sql:
+            if self.fail_training:
+                raise RuntimeError("training failed")
+            return FakeJob()
+        if "ML.EVALUATE" in sql:
+            target = sql.split("MODEL `")[1].split("`")[0]
+            return FakeJob([FakeRow(self.metrics[target])])
+        if "COUNT(DISTINCT" in sql:
+            return FakeJob([FakeRow(points=self.time_points)])
+        raise AssertionError(f"Unexpected query: {sql}")
+
+    def get_model(self, model_id):
+        name = model_id.split(".")[-1]
+        if name not in self.models:
+            raise NotFound(model_id)
+        return self.models[name]
+
+    def copy_table(self, source, destination, job_config=None):
+        self.copies.append((source, destination))
+        return FakeJob()
+
+    def delete_model(self, model_id, not_found_ok=False):
+        self.deleted.append(model_id)
+
+
+class FakeSnapshot:
+    def __init__(self, data, update_time=None):
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeDocument:
+    def __init__(self, store, collection, doc_id):
+        self.store = store
+        self.key = (collection, doc_id)
+
+    def _write(self, data):
+        self.store.docs[self.key] = data
+        self.store.update_times[self.key] = next(self.store.clock)
+        self.store.history.append((self.key, dict(data)))
+
+    def _check(self, option):
+        if self.key not in self.store.docs:
+            raise NotFound(str(self.key))
+        if option and option.last_update_time != self.store.update_times[self.key]:
+            raise FailedPrecondition(str(self.key))
+
+    def set(self, data, merge=False):
+        current = self.store.docs.get(self.key, {}) if merge else {}
+        self._write({**current, **data})
+
+    def create(self, data):
+        if self.key in self.store.docs:
+            raise AlreadyExists(str(self.key))
+        self._write(dict(data))
+
+    def update(self, data, option=None):
+        self._check(option)
+        self._write({**self.store.docs[self.key], **data})
+
+    def delete(self, option=None):
+        self._check(option)
+        del self.store.docs[self.key]
+
+    def get(self):
+        return FakeSnapshot(self.store.docs.get(self.key), self.store.update_times.get(self.key))
+
+
+class FakeCollection:
+    def __init__(self, store, name, field=None, descending=False, limit=None):
+        self.store = store
+        self.name = name
+        self.field = field
+        self.descending = descending
+        self._limit = limit
+
+    def document(self, doc_id):
+        return FakeDocument(self.store, self.name, doc_id)
+
+    def order_by(self, field, direction=None):
+        return FakeCollection(self.store, self.name, field,
+                              direction == main.firestore.Query.DESCENDING, self._limit)
+
+    def limit(self, count):
+        return FakeCollection(self.store, self.name, self.field, self.descending, count)
+
+    def stream(self):
+        docs = [d for (c, _), d in self.store.docs.items() if c == self.name]
+        if self.field:
+            docs.sort(key=lambda d: d[self.field], reverse=self.descending)
+        return [FakeSnapshot(d) for d in docs[:self._limit]]
+
+
+class FakeFirestoreClient:
+    """In-memory stand-in for firestore.Client; history records every write"""
+
+    def __init__(self):
+        self.docs = {}
+        self.update_times = {}
+        self.history = []
+        self.clock = itertools.count(1)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    @staticmethod
+    def write_option(last_update_time=None):
+        return SimpleNamespace(last_update_time=last_update_time)
+
+    def job(self, job_id):
+        return self.docs.get((main.RETRAIN_JOBS_COLLECTION, job_id))
+
+    def job_history(self, job_id):
+        return [doc for (c, d), doc in self.history if (c, d) == (main.RETRAIN_JOBS_COLLECTION, job_id)]
+
+
+def fake_model(name, created=datetime(2025, 1, 2), features=("feed_rate_tph", "kiln_outlet_t_c"),
+               model_type=None, label=None, training_options=None):
+    """Deployed model metadata as returned by bigquery.Client.get_model"""
+    config = main.RETRAIN_CONFIG[name]
+    model_type = model_type or config["model_type"]
+    label = label or config["label"]
+    options = dict(training_options or {})
+    if model_type == "ARIMA_PLUS":
+        options.setdefault("timeSeriesTimestampColumn", main.PARTITION_COLUMN)
+        options.setdefault("timeSeriesDataColumn", label)
+        label_columns, feature_columns = [], []
+    else:
+        options.setdefault("inputLabelColumns", [label])
+        label_columns = [SimpleNamespace(name=label)]
+        feature_columns = [SimpleNamespace(name=f) for f in features]
+    return SimpleNamespace(
+        created=created,
+        model_type=API_MODEL_TYPES.get(model_type, model_type),
+        label_columns=label_columns,
+        feature_columns=feature_columns,
+        training_runs=[{"trainingOptions": options}]
+    )
+
+
+def model_id(name, candidate=False, job_id=JOB_ID):
+    suffix = f"_candidate_{job_id[:8]}" if candidate else ""
+    return f"{main.PROJECT_ID}.{main.DATASET_ID}.{name}{suffix}"
+
+
+@pytest.fixture
+def firestore_client(monkeypatch):
+    fake = FakeFirestoreClient()
+    monkeypatch.setattr(main, "firestore_client", fake)
+    return fake
@@ -0,0 +1,449 @@
+"""
+Tests for the incremental BQML retraining orchestrator
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import JOB_ID, FakeBigQueryClient, fake_model, model_id
+
+PARTITIONS = ["20250101", "20250102", "20250103", "20250104"]
+SCHEDULER = "cementai-scheduler@cementai-optimiser.iam.gserviceaccount.com"
+
+
+def run_model(bq, name):
+    watermarks = main.get_training_watermarks(bq)
+    return main.retrain_model(bq, JOB_ID, name, watermarks, bq.partitions, lambda stage: None)
+
+
+def training_queries(bq):
+    return [q for q in bq.queries if "CREATE OR REPLACE MODEL" in q]
+
+
+def days(start, count):
+    return [main.shift_partition(start, i) for i in range(count)]
+
+
+# -------------------- retrain_model --------------------
+
+def test_mae_candidate_not_worse_is_promoted():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20250101"},
+        metrics={
+            model_id("tsr_optimizer", candidate=True): {"mean_absolute_error": 2.0},
+            model_id("tsr_optimizer"): {"mean_absolute_error": 2.0}
+        }
+    )
+    result = run_model(bq, "tsr_optimizer")
+
+    assert result["status"] == "PROMOTED"
+    assert result["comparison"] == "candidate_vs_production"
+    assert result["trained_through"] == "20250103"
+    assert result["holdout_partition"] == "20250104"
+    assert (model_id("tsr_optimizer", candidate=True), model_id("tsr_optimizer")) in bq.copies
+    assert bq.state["tsr_optimizer"] == "20250103"
+
+
+def test_auc_candidate_not_worse_is_promoted():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"pm_risk_classifier": fake_model("pm_risk_classifier")},
+        state={"pm_risk_classifier": "20250101"},
+        metrics={
+            model_id("pm_risk_classifier", candidate=True): {"roc_auc": 0.91},
+            model_id("pm_risk_classifier"): {"roc_auc": 0.90}
+        }
+    )
+    assert run_model(bq, "pm_risk_classifier")["status"] == "PROMOTED"
+    assert bq.state["pm_risk_classifier"] == "20250103"
+
+
+def test_regressed_candidate_is_rejected_and_watermark_unchanged():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"pm_risk_classifier": fake_model("pm_risk_classifier")},
+        state={"pm_risk_classifier": "20250101"},
+        metrics={
+            model_id("pm_risk_classifier", candidate=True): {"roc_auc": 0.80},
+            model_id("pm_risk_classifier"): {"roc_auc": 0.90}
+        }
+    )
+    result = run_model(bq, "pm_risk_classifier")
+
+    assert result["status"] == "REJECTED"
+    assert bq.state["pm_risk_classifier"] == "20250101"
+    assert not any(q for q in bq.queries if "MERGE" in q)
+    assert all(dest != model_id("pm_risk_classifier") for _, dest in bq.copies)
+
+
+def test_repeated_rejections_keep_warm_start_range_bounded():
+    bq = FakeBigQueryClient(
+        partitions=days("20250101", 120),
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20241231"},
+        metrics={
+            model_id("tsr_optimizer", candidate=True): {"mean_absolute_error": 3.0},
+            model_id("tsr_optimizer"): {"mean_absolute_error": 2.0}
+        }
+    )
+    first = run_model(bq, "tsr_optimizer")
+    bq.partitions.append(main.shift_partition(bq.partitions[-1], 1))
+    second = run_model(bq, "tsr_optimizer")
+
+    for result in (first, second):
+        assert result["status"] == "REJECTED"
+        assert result["trained_after"] == main.shift_partition(result["trained_through"], -main.RETRAIN_WINDOW_DAYS)
+    assert second["trained_after"] == main.shift_partition(first["trained_after"], 1)
+    assert bq.state["tsr_optimizer"] == "20241231"
+
+
+def test_fewer_than_two_new_partitions_is_up_to_date():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20250103"}
+    )
+    result = run_model(bq, "tsr_optimizer")
+
+    assert result["status"] == "UP_TO_DATE"
+    assert result["new_partitions"] == 1
+    assert training_queries(bq) == []
+
+
+def test_missing_state_row_falls_back_to_day_before_creation():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer", created=datetime(2025, 1, 3))},
+        metrics={
+            model_id("tsr_optimizer", candidate=True): {"mean_absolute_error": 1.0},
+            model_id("tsr_optimizer"): {"mean_absolute_error": 2.0}
+        }
+    )
+    result = run_model(bq, "tsr_optimizer")
+
+    assert result["previous_partition"] == "20250102"
+    assert result["new_partitions"] == 2
+    assert result["status"] == "PROMOTED"
+
+
+def test_undeployed_model_is_skipped():
+    bq = FakeBigQueryClient(partitions=PARTITIONS)
+    assert run_model(bq, "tsr_optimizer")["status"] == "NOT_DEPLOYED"
+
+
+def test_warm_start_copies_production_and_reuses_model_config():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"quality_regressor": fake_model(
+            "quality_regressor",
+            training_options={"hiddenUnits": ["128", "64"], "dropout": 0.2, "activationFn": "RELU"}
+        )},
+        state={"quality_regressor": "20250101"},
+        metrics={
+            model_id("quality_regressor", candidate=True): {"mean_absolute_error": 3.0},
+            model_id("quality_regressor"): {"mean_absolute_error": 2.0}
+        }
+    )
+    result = run_model(bq, "quality_regressor")
+    training = training_queries(bq)[0]
+
+    assert result["warm_start"] is True
+    assert bq.copies[0] == (model_id("quality_regressor"), model_id("quality_regressor", candidate=True))
+    assert f"MODEL `{model_id('quality_regressor', candidate=True)}`" in training
+    assert ("OPTIONS(model_type='DNN_REGRESSOR', input_label_cols=['quality_score'], "
+            "hidden_units=[128, 64], dropout=0.2, activation_fn='RELU', warm_start=TRUE)") in training
+    assert "SELECT feed_rate_tph, kiln_outlet_t_c, quality_score" in training
+    assert "PARSE_DATE('%Y%m%d', '20250101')" in training
+
+
+def test_cold_start_types_retrain_on_trailing_window_with_deployed_options():
+    assert main.RETRAIN_CONFIG["energy_regressor"]["model_type"] not in main.WARM_START_MODEL_TYPES
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"energy_regressor": fake_model(
+            "energy_regressor", training_options={"maxTreeDepth": "8", "subsample": 0.85}
+        )},
+        state={"energy_regressor": "20250101"},
+        metrics={
+            model_id("energy_regressor", candidate=True): {"mean_absolute_error": 3.0},
+            model_id("energy_regressor"): {"mean_absolute_error": 2.0}
+        }
+    )
+    result = run_model(bq, "energy_regressor")
+    training = training_queries(bq)[0]
+
+    assert result["warm_start"] is False
+    assert bq.copies == []
+    assert "warm_start" not in training
+    assert "max_tree_depth=8, subsample=0.85" in training
+    assert result["trained_after"] == main.shift_partition("20250103", -main.RETRAIN_WINDOW_DAYS)
+
+
+@pytest.mark.parametrize("overrides, reason", [
+    ({"model_type": "DNN_REGRESSOR"}, "model type"),
+    ({"label": "energy_kwh"}, "label"),
+    ({"training_options": {"instanceWeights": [{"columnName": "w"}]}}, "instanceWeights")
+])
+def test_deployed_config_mismatch_skips_training(overrides, reason):
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"energy_regressor": fake_model("energy_regressor", **overrides)},
+        state={"energy_regressor": "20250101"}
+    )
+    result = run_model(bq, "energy_regressor")
+
+    assert result["status"] == "CONFIG_MISMATCH"
+    assert reason in result["error"]
+    assert training_queries(bq) == []
+    assert bq.copies == []
+
+
+def test_arima_candidate_evaluated_at_its_own_cutoff_without_production_comparison():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"throughput_forecaster": fake_model(
+            "throughput_forecaster", training_options={"autoArima": True, "dataFrequency": "HOURLY"}
+        )},
+        state={"throughput_forecaster": "20250101"},
+        # Production is deliberately absent: evaluating it would raise KeyError
+        metrics={model_id("throughput_forecaster", candidate=True): {"mean_absolute_error": 40.0}},
+        time_points=24
+    )
+    result = run_model(bq, "throughput_forecaster")
+    evaluations = [q for q in bq.queries if "ML.EVALUATE" in q]
+
+    assert result["status"] == "PROMOTED"
+    assert result["comparison"] == "candidate_only"
+    assert result["production_metric"] is None
+    assert len(evaluations) == 1
+    assert "STRUCT(TRUE AS perform_aggregation, 24 AS horizon)" in evaluations[0]
+    assert ("time_series_timestamp_col='event_time', time_series_data_col='throughput_tph', "
+            "auto_arima=TRUE, data_frequency='HOURLY'") in training_queries(bq)[0]
+
+
+def test_arima_candidate_without_metric_is_rejected():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"throughput_forecaster": fake_model("throughput_forecaster")},
+        state={"throughput_forecaster": "20250101"},
+        metrics={model_id("throughput_forecaster", candidate=True): {"mean_absolute_error": None}}
+    )
+    assert run_model(bq, "throughput_forecaster")["status"] == "REJECTED"
+    assert bq.state["throughput_forecaster"] == "20250101"
+
+
+def test_candidate_deleted_when_training_fails():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20250101"}
+    )
+    bq.fail_training = True
+
+    with pytest.raises(RuntimeError):
+        run_model(bq, "tsr_optimizer")
+    assert bq.deleted == [model_id("tsr_optimizer", candidate=True)]
+
+
+def test_promotion_with_failed_watermark_save_is_reported():
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20250101"},
+        metrics={
+            model_id("tsr_optimizer", candidate=True): {"mean_absolute_error": 1.0},
+            model_id("tsr_optimizer"): {"mean_absolute_error": 2.0}
+        }
+    )
+    bq.fail_merge = True
+    result = run_model(bq, "tsr_optimizer")
+
+    assert result["status"] == "PROMOTED_STATE_NOT_SAVED"
+    assert result["promoted"] is True
+    assert "merge failed" in result["error"]
+    assert (model_id("tsr_optimizer", candidate=True), model_id("tsr_optimizer")) in bq.copies
+
+
+# -------------------- jobs, lock and worker --------------------
+
+def queue_job(job_id, models):
+    assert main.acquire_retrain_lock(job_id) is None
+    main.create_retrain_job(job_id, models)
+
+
+def lock_holder(firestore_client):
+    lock = firestore_client.docs.get((main.RETRAIN_LOCKS_COLLECTION, main.RETRAIN_LOCK_DOCUMENT))
+    return lock["job_id"] if lock else None
+
+
+def test_job_moves_from_queued_to_completed(firestore_client):
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={
+            "tsr_optimizer": fake_model("tsr_optimizer"),
+            "heat_loss_regressor": fake_model("heat_loss_regressor")
+        },
+        state={"tsr_optimizer": "20250101", "heat_loss_regressor": "20250103"},
+        metrics={
+            model_id("tsr_optimizer", candidate=True): {"mean_absolute_error": 1.0},
+            model_id("tsr_optimizer"): {"mean_absolute_error": 2.0}
+        }
+    )
+    queue_job(JOB_ID, ["tsr_optimizer", "heat_loss_regressor"])
+    job = main.claim_retrain_job()
+    main.process_retrain_job(job, bq)
+
+    history = firestore_client.job_history(JOB_ID)
+    assert list(dict.fromkeys(doc["status"] for doc in history)) == ["QUEUED", "RUNNING", "COMPLETED"]
+    assert list(dict.fromkeys(doc["progress_pct"] for doc in history)) == [0.0, 50.0, 100.0]
+    job = firestore_client.job(JOB_ID)
+    assert job["completed_models"] == 2
+    assert [r["status"] for r in job["results"]] == ["PROMOTED", "UP_TO_DATE"]
+    assert lock_holder(firestore_client) is None
+
+
+def test_job_with_failed_model_completes_with_errors(firestore_client):
+    bq = FakeBigQueryClient(
+        partitions=PARTITIONS,
+        models={"tsr_optimizer": fake_model("tsr_optimizer")},
+        state={"tsr_optimizer": "20250101"}
+    )
+    bq.fail_training = True
+    queue_job(JOB_ID, ["tsr_optimizer"])
+    main.process_retrain_job(main.claim_retrain_job(), bq)
+
+    job = firestore_client.job(JOB_ID)
+    assert job["status"] == "COMPLETED_WITH_ERRORS"
+    assert job["results"][0]["status"] == "FAILED"
+
+
+def test_queued_job_is_claimed_by_one_worker_only(firestore_client):
+    queue_job(JOB_ID, ["tsr_optimizer"])
+
+    assert main.claim_retrain_job()["job_id"] == JOB_ID
+    assert main.claim_retrain_job() is None
+    assert firestore_client.job(JOB_ID)["status"] == "RUNNING"
+
+
+def test_second_job_is_refused_while_one_is_active(firestore_client):
+    queue_job(JOB_ID, ["tsr_optimizer"])
+    main.claim_retrain_job()
+
+    active = main.acquire_retrain_lock("other-job")
+    assert active["job_id"] == JOB_ID
+    assert lock_holder(firestore_client) == JOB_ID
+
+
+def test_stale_running_job_is_failed_and_lock_released(firestore_client):
+    queue_job(JOB_ID, ["tsr_optimizer"])
+    main.claim_retrain_job()
+    # Simulate an instance that stopped heartbeating mid-job
+    old = (datetime.utcnow() - main.RETRAIN_STALE_AFTER - timedelta(minutes=1)).isoformat()
+    firestore_client.docs[(main.RETRAIN_JOBS_COLLECTION, JOB_ID)]["updated_at"] = old
+
+    assert main.claim_retrain_job() is None
+    job = firestore_client.job(JOB_ID)
+    assert job["status"] == "FAILED"
+    assert "No heartbeat" in job["error"]
+    assert lock_holder(firestore_client) is None
+    assert main.acquire_retrain_lock("next-job") is None
+
+
+def test_finished_job_lock_is_released_for_next_job(firestore_client):
+    queue_job(JOB_ID, ["tsr_optimizer"])
+    main.update_retrain_job(JOB_ID, status="COMPLETED")
+
+    assert main.acquire_retrain_lock("next-job") is None
+    assert lock_holder(firestore_client) == "next-job"
+
+
+# -------------------- endpoints --------------------
+
+def fake_verify(token, request, audience=None):
+    if token == "scheduler-token":
+        return {"email": SCHEDULER, "email_verified": True}
+    if token == "other-token":
+        return {"email": "someone@example.com", "email_verified": True}
+    raise ValueError("bad signature")
+
+
+AUTH = {"Authorization": "Bearer scheduler-token"}
+
+
+@pytest.fixture
+def api(monkeypatch, firestore_client):
+    monkeypatch.setattr(main, "client", FakeBigQueryClient())
+    monkeypatch.setattr(main, "ensure_retrain_worker", lambda: None)
+    monkeypatch.setattr(main, "RETRAIN_OIDC_AUDIENCE", "https://backend.example")
+    monkeypatch.setattr(main, "RETRAIN_INVOKER_EMAILS", {SCHEDULER})
+    monkeypatch.setattr(main.id_token, "verify_oauth2_token", fake_verify)
+    return TestClient(main.app)
+
+
+def test_retrain_endpoint_queues_deduplicated_models(api, firestore_client):
+    response = api.post("/api/models/retrain", headers=AUTH,
+                        json={"models": ["tsr_optimizer", "mill_optimizer", "tsr_optimizer"]})
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["models"] == ["tsr_optimizer", "mill_optimizer"]
+    assert lock_holder(firestore_client) == body["job_id"]
+
+    job = api.get(f"/api/models/retrain/jobs/{body['job_id']}")
+    assert job.status_code == 200
+    assert job.json()["status"] == "QUEUED"
+    assert api.get("/api/models/retrain/jobs").json()["jobs"][0]["job_id"] == body["job_id"]
+
+
+def test_retrain_endpoint_returns_409_while_job_active(api):
+    first = api.post("/api/models/retrain", headers=AUTH).json()
+    response = api.post("/api/models/retrain", headers=AUTH)
+
+    assert response.status_code == 409
+    assert response.json()["detail"]["job_id"] == first["job_id"]
+
+
+def test_retrain_endpoint_defaults_to_all_models(api):
+    response = api.post("/api/models/retrain", headers=AUTH)
+    assert response.status_code == 202
+    assert response.json()["models"] == main.BQML_MODELS
+
+
+@pytest.mark.parametrize("models", [[], ["not_a_model"]])
+def test_retrain_endpoint_rejects_bad_model_lists(api, models):
+    assert api.post("/api/models/retrain", headers=AUTH, json={"models": models}).status_code == 400
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({}, 401),
+    ({"Authorization": "Bearer forged"}, 401),
+    ({"Authorization": "Bearer other-token"}, 403)
+])
+def test_retrain_endpoint_requires_allowed_invoker(api, firestore_client, headers, status):
+    assert api.post("/api/models/retrain", headers=headers).status_code == status
+    assert lock_holder(firestore_client) is None
+
+
+def test_retrain_endpoint_refuses_when_auth_not_configured(api, monkeypatch):
+    monkeypatch.setattr(main, "RETRAIN_INVOKER_EMAILS", set())
+    assert api.post("/api/models/retrain", headers=AUTH).status_code == 503
+
+
+def test_unknown_job_returns_404(api):
+    assert api.get("/api/models/retrain/jobs/missing").status_code == 404
+
+
+def test_endpoints_return_503_without_clients(api, monkeypatch):
+    monkeypatch.setattr(main, "client", None)
+    assert api.post("/api/models/retrain", headers=AUTH).status_code == 503
+    assert api.get("/api/models/training-state").status_code == 503
+
+    monkeypatch.setattr(main, "client", FakeBigQueryClient())
+    monkeypatch.setattr(main, "firestore_client", None)
+    assert api.post("/api/models/retrain", headers=AUTH).status_code == 503
+    assert api.get("/api/models/retrain/jobs/missing").status_code == 503